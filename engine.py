@@ -1,13 +1,25 @@
+import asyncio
+import functools
+import hashlib
+import io
 import logging
+import logging.handlers
+import multiprocessing
+import multiprocessing.util
 import os
+import tempfile
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+import pypdfium2 as pdfium
 from docling.datamodel.base_models import InputFormat
 from docling.document_converter import DocumentConverter, PdfFormatOption
 from docling.datamodel.pipeline_options import PdfPipelineOptions
+from docling_core.types.doc import DoclingDocument
 from typing import Union, List, Optional, Literal, Set
 from pathlib import Path
 from google import genai
 from google.genai import types
+from google.genai.client import AsyncClient
 from PIL import Image
 from dotenv import load_dotenv
 
@@ -17,60 +29,165 @@ load_dotenv()
 
 logs_dir = Path("logs")
 logs_dir.mkdir(exist_ok=True)
-log_file = logs_dir / f"run_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
+log_file = Path(os.environ.setdefault(
+    "ENGINE_LOG_FILE",
+    str(logs_dir / f"run_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"),
+))
+
+_FMT = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%H:%M:%S')
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
+logger.propagate = False
 
 if not logger.handlers:
-    file_handler = logging.FileHandler(log_file, mode='w')
+    file_handler = logging.FileHandler(log_file, mode='a', delay=True)
     file_handler.setLevel(logging.INFO)
-    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    file_handler.setFormatter(_FMT)
+
+    buffered_file_handler = logging.handlers.MemoryHandler(
+        capacity=1024,
+        flushLevel=logging.ERROR,
+        target=file_handler,
+    )
+    buffered_file_handler.setLevel(logging.INFO)
 
     console_handler = logging.StreamHandler()
     console_handler.setLevel(logging.INFO)
-    console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    console_handler.setFormatter(_FMT)
 
-    logger.addHandler(file_handler)
+    logger.addHandler(buffered_file_handler)
     logger.addHandler(console_handler)
 
+MAX_CONCURRENT_DESCRIPTIONS = 8
+MIN_PAGES_TO_SPLIT = 100
+MAX_DESCRIPTION_IMAGE_SIZE = 1024
+GEMINI_MODEL = "gemini-2.0-flash-exp"
+DESCRIPTION_PROMPT = "Describe this image in detail, focusing on the key content and information it conveys."
+
+DEFAULT_PIPELINE_OPTIONS = {
+    "generate_page_images": True,
+    "images_scale": 2.00,
+    "do_picture_description": False,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _build_converter(opts_key: tuple) -> DocumentConverter:
+    logger.info("Loading Docling converter")
+    return DocumentConverter(
+        format_options={
+            InputFormat.PDF: PdfFormatOption(
+                pipeline_options=PdfPipelineOptions(**dict(opts_key)),
+            ),
+        }
+    )
+
+
+def _fill_placeholders(text: str, placeholder: str, replacements: dict[int, str]) -> str:
+    if not replacements:
+        return text
+    parts = text.split(placeholder, max(replacements))
+    out = [parts[0]]
+    for idx, part in enumerate(parts[1:], 1):
+        out.append(replacements.get(idx, placeholder))
+        out.append(part)
+    return "".join(out)
+
+
+def _run_coroutine(coro):
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+def _convert_chunk(chunk_path: str, opts_key: tuple) -> DoclingDocument:
+    return _build_converter(opts_key).convert(chunk_path).document
+
+
+_WORKER_ENGINE: Optional["Engine"] = None
+
+
+def _init_engine_worker(
+    data_dir: Path,
+    results_dir: Path,
+    opts_key: tuple,
+    use_cache: bool,
+    max_image_size: Optional[int],
+) -> None:
+    global _WORKER_ENGINE
+    _build_converter(opts_key)
+    _WORKER_ENGINE = Engine(data_dir, results_dir, dict(opts_key), use_cache, max_image_size)
+    multiprocessing.util.Finalize(None, _WORKER_ENGINE.close, exitpriority=10)
+
+
+def _process_one(name: str, export_formats: Set[ExportFormat], existing: Set[str]) -> str:
+    _WORKER_ENGINE.process_file(name, export_formats, existing=existing)
+    _WORKER_ENGINE.wait_for_writes()
+    return name
+
+
 class Engine:
-    def __init__(self):
+    def __init__(
+        self,
+        data_dir: Union[str, Path] = "data",
+        results_dir: Union[str, Path] = "results",
+        pipeline_options: Optional[dict] = None,
+        use_cache: bool = True,
+        max_image_size: Optional[int] = MAX_DESCRIPTION_IMAGE_SIZE,
+    ):
         logger.info("Initializing Engine")
         logger.info("Using Docling for text extraction")
 
-        pipeline_options = PdfPipelineOptions(
-            generate_page_images=True,
-            images_scale=2.00,
-            do_picture_description=False,
-        )
-
-        self.converter = DocumentConverter(
-            format_options={
-                InputFormat.PDF: PdfFormatOption(
-                    pipeline_options=pipeline_options,
-                ),
-            }
-        )
+        self.pipeline_options = dict(pipeline_options or DEFAULT_PIPELINE_OPTIONS)
+        self.opts_key = tuple(sorted(self.pipeline_options.items()))
 
         api_key = os.getenv("GEMINI_API_KEY")
         if not api_key:
             logger.warning("GEMINI_API_KEY not found in environment")
 
-        self.gemini_client = genai.Client(api_key=api_key)
-        logger.info("Gemini client initialized for image descriptions")
+        self.gemini_api_key = api_key
+        logger.info("Gemini configured for image descriptions")
 
-        self.results_dir = Path("results")
+        self.results_dir = Path(results_dir)
         self.results_dir.mkdir(exist_ok=True)
-        self.data_dir = Path("data")
+        self.data_dir = Path(data_dir)
         self.data_dir.mkdir(exist_ok=True)
         logger.info(f"Data directory: {self.data_dir}")
         logger.info(f"Results directory: {self.results_dir}")
 
+        self.use_cache = use_cache
+        self.description_cache_dir = self.results_dir / ".desc_cache"
+        if self.use_cache:
+            self.description_cache_dir.mkdir(exist_ok=True)
+            logger.info(f"Description cache directory: {self.description_cache_dir}")
+
+        self.max_image_size = max_image_size
+
+        self._io_pool = ThreadPoolExecutor(max_workers=2)
+        self._pending_writes: List[tuple[Path, Future]] = []
+        self._failed_writes: List[Path] = []
+
+    def __enter__(self) -> "Engine":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        try:
+            self.wait_for_writes()
+        finally:
+            self._io_pool.shutdown()
+
     def run(
         self,
         file_names: Union[str, List[str]],
-        export_formats: Optional[Union[ExportFormat, List[ExportFormat]]] = None
+        export_formats: Optional[Union[ExportFormat, List[ExportFormat]]] = None,
+        max_workers: Optional[int] = None
     ) -> None:
         if isinstance(file_names, str):
             file_names = [file_names]
@@ -85,131 +202,363 @@ class Engine:
         logger.info(f"Starting conversion process for {len(file_names)} file(s)")
         logger.info(f"Export formats: {', '.join(export_formats_set)}")
 
-        for idx, name in enumerate(file_names, 1):
-            logger.info(f"[{idx}/{len(file_names)}] Processing: {name}")
-
-            path = self.data_dir / name
-
-            output_paths = {}
-            if "markdown" in export_formats_set:
-                output_paths["markdown"] = self.results_dir / f"{path.stem}.md"
-            if "doctags" in export_formats_set:
-                output_paths["doctags"] = self.results_dir / f"{path.stem}_doctags.xml"
-
-            if all(p.exists() for p in output_paths.values()):
-                logger.info(f"All outputs already exist for {name}, skipping conversion")
-                continue
-
-            logger.info(f"Converting {name}...")
-            result = self.convert(path)
-            logger.info(f"Conversion complete for {name}")
-
-            logger.info(f"Running post-processing for images...")
-            outputs = self.post_processing(result, path.stem, export_formats_set)
+        existing = {entry.name for entry in os.scandir(self.results_dir)}
+
+        split_pages = len(file_names) == 1 and max_workers != 1
+        split_workers = max_workers
+        if max_workers is None:
+            max_workers = min(len(file_names), os.cpu_count() or 1)
+
+        if max_workers <= 1 or len(file_names) == 1:
+            for idx, name in enumerate(file_names, 1):
+                logger.info(f"[{idx}/{len(file_names)}] Processing: {name}")
+                self.process_file(
+                    name,
+                    export_formats_set,
+                    split_pages=split_pages,
+                    existing=existing,
+                    max_workers=split_workers,
+                )
+                logger.info(f"[{idx}/{len(file_names)}] Completed: {name}")
+        else:
+            logger.info(f"Processing files with {max_workers} worker processes")
+            with ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_engine_worker,
+                initargs=(self.data_dir, self.results_dir, self.opts_key, self.use_cache, self.max_image_size),
+            ) as executor:
+                completed = executor.map(
+                    _process_one,
+                    file_names,
+                    [export_formats_set] * len(file_names),
+                    [
+                        existing & {p.name for p in self.output_paths(name, export_formats_set).values()}
+                        for name in file_names
+                    ],
+                )
+                for idx, name in enumerate(completed, 1):
+                    logger.info(f"[{idx}/{len(file_names)}] Completed: {name}")
+
+        self.wait_for_writes()
+        logger.info("All conversions complete")
 
-            for format_type, content in outputs.items():
-                output_path = output_paths[format_type]
-                logger.info(f"Writing {format_type} to: {output_path}")
-                output_path.write_text(content, encoding="utf-8")
+    def process_file(
+        self,
+        name: str,
+        export_formats: Set[ExportFormat],
+        split_pages: bool = False,
+        existing: Optional[Set[str]] = None,
+        max_workers: Optional[int] = None
+    ) -> None:
+        path = self.data_dir / name
+        output_paths = self.output_paths(name, export_formats)
+
+        if existing is None:
+            existing = {entry.name for entry in os.scandir(self.results_dir)}
+        missing_formats = {f for f, p in output_paths.items() if p.name not in existing}
+        if not missing_formats:
+            logger.info(f"All outputs already exist for {name}, skipping conversion")
+            return
+        if missing_formats != export_formats:
+            logger.info(f"Only exporting missing formats for {name}: {', '.join(missing_formats)}")
+
+        logger.info(f"Converting {name}...")
+        if split_pages and path.suffix.lower() == ".pdf":
+            document = self.convert_parallel(path, max_workers=max_workers)
+        else:
+            document = self.convert(path).document
+        logger.info(f"Conversion complete for {name}")
+
+        logger.info(f"Running post-processing for images...")
+        outputs = self.post_processing(document, path.stem, missing_formats)
+
+        self._failed_writes.extend(self._join_writes())
+        for format_type, content in outputs.items():
+            output_path = output_paths[format_type]
+            logger.info(f"Writing {format_type} to: {output_path}")
+            self._pending_writes.append(
+                (output_path, self._io_pool.submit(output_path.write_text, content, encoding="utf-8"))
+            )
 
-            logger.info(f"[{idx}/{len(file_names)}] Completed: {name}")
+    def output_paths(self, name: str, export_formats: Set[ExportFormat]) -> dict[ExportFormat, Path]:
+        stem = Path(name).stem
+        output_paths = {}
+        if "markdown" in export_formats:
+            output_paths["markdown"] = self.results_dir / f"{stem}.md"
+        if "doctags" in export_formats:
+            output_paths["doctags"] = self.results_dir / f"{stem}_doctags.xml"
+        return output_paths
 
-        logger.info("All conversions complete")
+    def _join_writes(self) -> List[Path]:
+        pending, self._pending_writes = self._pending_writes, []
+        failed = []
+        for output_path, future in pending:
+            try:
+                future.result()
+            except OSError as e:
+                logger.error(f"Failed to write {output_path}: {e}")
+                failed.append(output_path)
+        return failed
+
+    def wait_for_writes(self) -> None:
+        failed = self._failed_writes + self._join_writes()
+        self._failed_writes = []
+        if failed:
+            raise OSError(f"Failed to write {', '.join(str(p) for p in failed)}")
+
+    @property
+    def converter(self) -> DocumentConverter:
+        return _build_converter(self.opts_key)
 
     def convert(self, path: Path):
         return self.converter.convert(str(path))
 
-    def describe_image_with_gemini(self, image_path: Path, context: str = "") -> Optional[str]:
+    def convert_parallel(
+        self,
+        path: Path,
+        pages_per_chunk: int = 5,
+        max_workers: Optional[int] = None
+    ) -> DoclingDocument:
+        pdf = pdfium.PdfDocument(str(path))
         try:
-            with open(image_path, "rb") as f:
-                image_data = f.read()
-
-            prompt = "Describe this image in detail, focusing on the key content and information it conveys."
-            if context:
-                prompt = f"{context}\n\n{prompt}"
+            n_pages = len(pdf)
+            if max_workers is None:
+                max_workers = os.cpu_count() or 1
+            pages_per_chunk = max(pages_per_chunk, n_pages // (4 * max_workers))
+            chunk_starts = list(range(0, n_pages, pages_per_chunk))
+            # Each worker loads its own model set, so only split when every worker gets at least two chunks
+            max_workers = min(max_workers, len(chunk_starts) // 2)
+
+            if n_pages < MIN_PAGES_TO_SPLIT or max_workers < 2:
+                return self.convert(path).document
+
+            logger.info(
+                f"Splitting {path.name} ({n_pages} pages) into {len(chunk_starts)} chunks "
+                f"of up to {pages_per_chunk} pages across {max_workers} workers"
+            )
 
-            response = self.gemini_client.models.generate_content(
-                model="gemini-2.0-flash-exp",
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                chunk_paths = []
+                for start in chunk_starts:
+                    chunk = pdfium.PdfDocument.new()
+                    chunk.import_pages(pdf, pages=list(range(start, min(start + pages_per_chunk, n_pages))))
+                    chunk_path = Path(tmp_dir) / f"{path.stem}_pages_{start + 1}.pdf"
+                    chunk.save(str(chunk_path))
+                    chunk.close()
+                    chunk_paths.append(str(chunk_path))
+
+                with ProcessPoolExecutor(
+                    max_workers=max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_build_converter,
+                    initargs=(self.opts_key,),
+                ) as executor:
+                    futures = [
+                        executor.submit(_convert_chunk, chunk_path, self.opts_key)
+                        for chunk_path in chunk_paths
+                    ]
+                    documents = []
+                    for idx, future in enumerate(futures, 1):
+                        documents.append(future.result())
+                        logger.info(f"Converted chunk {idx}/{len(futures)} of {path.name}")
+        finally:
+            pdf.close()
+
+        document = DoclingDocument.concatenate(documents)
+        document.name = path.stem
+        return document
+
+    async def describe_image_with_gemini(
+        self,
+        client: AsyncClient,
+        image_data: bytes,
+        mime_type: str,
+        image_name: str,
+        prompt: str
+    ) -> Optional[str]:
+        try:
+            response = await client.models.generate_content(
+                model=GEMINI_MODEL,
                 contents=[
                     types.Part(text=prompt),
-                    types.Part(inline_data=types.Blob(data=image_data, mime_type="image/png"))
+                    types.Part(inline_data=types.Blob(data=image_data, mime_type=mime_type))
                 ]
             )
 
             description = response.text
-            logger.info(f"Generated description for {image_path.name}")
+            logger.info(f"Generated description for {image_name}")
             return description
 
         except Exception as e:
-            logger.error(f"Error describing image {image_path}: {e}")
+            logger.error(f"Error describing image {image_name}: {e}")
+            return None
+
+    def _read_cached_description(self, key: str) -> Optional[str]:
+        cache_path = self.description_cache_dir / f"{key}.txt"
+        try:
+            return cache_path.read_text(encoding="utf-8") or None
+        except FileNotFoundError:
             return None
+        except (OSError, UnicodeDecodeError) as e:
+            logger.warning(f"Ignoring unreadable cached description {cache_path}: {e}")
+            return None
+
+    def _write_cached_description(self, key: str, description: str) -> None:
+        cache_path = self.description_cache_dir / f"{key}.txt"
+        tmp_path = None
+        try:
+            with tempfile.NamedTemporaryFile(
+                "w", encoding="utf-8", dir=self.description_cache_dir, suffix=".tmp", delete=False
+            ) as tmp_file:
+                tmp_path = tmp_file.name
+                tmp_file.write(description)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logger.warning(f"Could not cache description to {cache_path}: {e}")
+            if tmp_path is not None:
+                Path(tmp_path).unlink(missing_ok=True)
+
+    async def describe_images(
+        self,
+        images: List[tuple[bytes, str, str]],
+        context: str = ""
+    ) -> List[Optional[str]]:
+        prompt = f"{context}\n\n{DESCRIPTION_PROMPT}" if context else DESCRIPTION_PROMPT
+        prompt_hash = hashlib.sha1(f"{GEMINI_MODEL}{prompt}".encode()).hexdigest()
+
+        keys = [f"{hashlib.blake2b(image_data).hexdigest()}_{prompt_hash}" for image_data, _, _ in images]
+        descriptions: dict[str, Optional[str]] = {}
+        to_request: dict[str, tuple[bytes, str, str]] = {}
+        for key, (image_data, mime_type, image_name) in zip(keys, images):
+            if key in descriptions or key in to_request:
+                continue
+            cached = self._read_cached_description(key) if self.use_cache else None
+            if cached:
+                logger.info(f"Using cached description for {image_name}")
+                descriptions[key] = cached
+            else:
+                to_request[key] = (image_data, mime_type, image_name)
+
+        if to_request:
+            try:
+                client = genai.Client(api_key=self.gemini_api_key).aio
+            except Exception as e:
+                logger.error(f"Could not create Gemini client, skipping {len(to_request)} image descriptions: {e}")
+                results = [None] * len(to_request)
+            else:
+                semaphore = asyncio.Semaphore(MAX_CONCURRENT_DESCRIPTIONS)
+
+                async def describe(image_data: bytes, mime_type: str, image_name: str) -> Optional[str]:
+                    async with semaphore:
+                        return await self.describe_image_with_gemini(
+                            client, image_data, mime_type, image_name, prompt
+                        )
+
+                async with client:
+                    results = await asyncio.gather(
+                        *(describe(*request) for request in to_request.values()),
+                        return_exceptions=True,
+                    )
+            for key, description in zip(to_request, results):
+                if not isinstance(description, str):
+                    description = None
+                descriptions[key] = description
+                if self.use_cache and description:
+                    self._write_cached_description(key, description)
+
+        return [descriptions[key] for key in keys]
 
     def post_processing(
         self,
-        result,
+        document: DoclingDocument,
         output_stem: str,
         export_formats: Set[ExportFormat],
         context: str = ""
     ) -> dict[ExportFormat, str]:
         logger.info("Starting post-processing for image descriptions")
 
-        outputs = {}
-        if "markdown" in export_formats:
-            outputs["markdown"] = result.document.export_to_markdown()
-        if "doctags" in export_formats:
-            outputs["doctags"] = result.document.export_to_document_tokens()
+        exporters = {
+            "markdown": document.export_to_markdown,
+            "doctags": document.export_to_document_tokens,
+        }
+        outputs = {f: export() for f, export in exporters.items() if f in export_formats}
 
-        images = result.document.pictures
+        images = list(document.pictures)
         if not images:
             logger.info("No images found in document")
             return outputs
 
-        logger.info(f"Found {len(images)} images to process")
+        n_images = len(images)
+        logger.info(f"Found {n_images} images to process")
 
-        image_descriptions = []
+        results_dir = self.results_dir
+        image_prefix = f"{output_stem}_image_"
+        save_images = "markdown" in export_formats
+
+        pending: List[tuple[int, bytes]] = []
         for idx, image in enumerate(images, 1):
-            logger.info(f"Processing image {idx}/{len(images)}")
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(f"Processing image {idx}/{n_images}")
 
             try:
-                image_path = self.results_dir / f"{output_stem}_image_{idx}.png"
-                pil_image = image.get_image(result.document)
+                image_path = results_dir / f"{image_prefix}{idx}.png"
+                pil_image = image.get_image(document)
 
                 if pil_image is None:
                     logger.warning(f"Could not extract image {idx}, skipping")
-                    image_descriptions.append(None)
                     continue
 
-                pil_image.save(image_path)
-                logger.info(f"Saved image to {image_path}")
+                if save_images:
+                    pil_image.save(image_path)
+                    logger.info(f"Saved image to {image_path}")
+
+                if pil_image.mode not in ("RGB", "L"):
+                    pil_image = pil_image.convert("RGB")
+                if self.max_image_size and max(pil_image.size) > self.max_image_size:
+                    pil_image.thumbnail((self.max_image_size, self.max_image_size), Image.Resampling.LANCZOS)
+                buffer = io.BytesIO()
+                pil_image.save(buffer, format="JPEG", quality=85, optimize=False)
 
-                description = self.describe_image_with_gemini(image_path, context)
-                image_descriptions.append({
-                    "index": idx,
-                    "path": image_path.name,
-                    "description": description
-                })
+                pending.append((idx, buffer.getvalue()))
 
             except Exception as e:
                 logger.error(f"Error processing image {idx}: {e}")
-                image_descriptions.append(None)
                 continue
 
+        descriptions_by_idx: dict[int, str] = {}
+        if pending:
+            logger.info(f"Requesting {len(pending)} image descriptions concurrently")
+            descriptions = _run_coroutine(self.describe_images(
+                [(image_data, "image/jpeg", f"{image_prefix}{idx}.png") for idx, image_data in pending],
+                context
+            ))
+            descriptions_by_idx = {
+                idx: description
+                for (idx, _), description in zip(pending, descriptions)
+                if description
+            }
+
         for format_type in export_formats:
             if format_type == "markdown":
-                for img_data in image_descriptions:
-                    if img_data and img_data["description"]:
-                        placeholder = "<!-- image -->"
-                        if placeholder in outputs["markdown"]:
-                            replacement = f"![Image {img_data['index']}]({img_data['path']})\n\n**Image Description:** {img_data['description']}"
-                            outputs["markdown"] = outputs["markdown"].replace(placeholder, replacement, 1)
+                outputs["markdown"] = _fill_placeholders(
+                    outputs["markdown"],
+                    "<!-- image -->",
+                    {
+                        idx: f"![Image {idx}]({image_prefix}{idx}.png)\n\n**Image Description:** {description}"
+                        for idx, description in descriptions_by_idx.items()
+                    }
+                )
 
             elif format_type == "doctags":
-                for img_data in image_descriptions:
-                    if img_data and img_data["description"]:
-                        placeholder = "<picture>"
-                        if placeholder in outputs["doctags"]:
-                            replacement = f'<picture description="{img_data["description"]}">'
-                            outputs["doctags"] = outputs["doctags"].replace(placeholder, replacement, 1)
+                outputs["doctags"] = _fill_placeholders(
+                    outputs["doctags"],
+                    "<picture>",
+                    {
+                        idx: f'<picture description="{description}">'
+                        for idx, description in descriptions_by_idx.items()
+                    }
+                )
 
         logger.info("Post-processing complete")
         return outputs 
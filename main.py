@@ -1,11 +1,17 @@
+import argparse
+
 from engine import Engine
 
 def main() -> None:
-    engine = Engine()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--no-cache", action="store_true", help="Ignore and don't update cached image descriptions")
+    args = parser.parse_args()
+
     # data = ["medical_3d_printing.pdf", "trace_anything.pdf", "vision_language_models.pdf", "farm.pdf"]
     data = "farm.pdf"
     export_formats = ["doctags", "markdown"]
-    engine.run(data, export_formats=export_formats)
+    with Engine(use_cache=not args.no_cache) as engine:
+        engine.run(data, export_formats=export_formats)
 
 if __name__ == "__main__":
     main()